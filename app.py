@@ -1,22 +1,55 @@
-from flask import Flask, render_template, request, jsonify, stream_template
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 import json
 import os
+import threading
 from datetime import datetime
-from rag_gemini import RAGWithGemini
 
 app = Flask(__name__)
 
+SAMPLE_QUESTIONS = [
+    "What is FPG Berhad and what do they do?",
+    "Tell me about FPG's M&A advisory services",
+    "What is FPG's global presence?",
+    "What are FPG's investment sectors?",
+    "Tell me about FPG's vision and mission",
+    "What successful M&A cases has FPG completed?"
+]
+
 # Initialize RAG system
 rag_system = None
+rag_init_error = None
+# Concurrent first requests must not each build their own RAGWithGemini
+rag_init_lock = threading.Lock()
 
 def initialize_rag():
     """Initialize the RAG system"""
-    global rag_system
-    try:
-        rag_system = RAGWithGemini()
-        return True, "RAG system initialized successfully"
-    except Exception as e:
-        return False, f"Failed to initialize RAG system: {str(e)}"
+    global rag_system, rag_init_error
+    with rag_init_lock:
+        if rag_system is not None:
+            return True, "RAG system initialized successfully"
+        try:
+            # Imported here so the web server starts without loading torch,
+            # sentence-transformers, chromadb and the Gemini SDK
+            from rag_gemini import RAGWithGemini
+            system = RAGWithGemini()
+            # Concurrent /api/chat requests share Gemini calls
+            system.enable_batching()
+            rag_system = system
+            rag_init_error = None
+            return True, "RAG system initialized successfully"
+        except Exception as e:
+            rag_init_error = f"Failed to initialize RAG system: {str(e)}"
+            return False, rag_init_error
+
+def format_similarity_scores(context_used):
+    """Source/score pairs shown under each answer in the UI"""
+    return [
+        {
+            'source': doc['source'],
+            'score': round(doc['similarity_score'], 3)
+        }
+        for doc in context_used
+    ]
 
 @app.route('/')
 def index():
@@ -56,13 +89,7 @@ def chat():
             'error': False,
             'message': result['answer'],
             'sources': result['sources'],
-            'similarity_scores': [
-                {
-                    'source': doc['source'],
-                    'score': round(doc['similarity_score'], 3)
-                }
-                for doc in result['context_used']
-            ],
+            'similarity_scores': format_similarity_scores(result['context_used']),
             'timestamp': datetime.now().strftime('%H:%M')
         }
         
@@ -74,52 +101,106 @@ def chat():
             'message': f'Error processing your message: {str(e)}'
         })
 
+@app.route('/api/chat/stream')
+def chat_stream():
+    """Handle chat messages, streaming the answer as server-sent events"""
+    global rag_system
+    
+    user_message = request.args.get('message', '').strip()
+    
+    def sse(payload):
+        return f"data: {json.dumps(payload)}\n\n"
+    
+    def generate():
+        global rag_system
+        
+        if not user_message:
+            yield sse({'error': True, 'message': 'Please enter a message'})
+            return
+        
+        # Initialize RAG system if not already done
+        if rag_system is None:
+            success, msg = initialize_rag()
+            if not success:
+                yield sse({'error': True, 'message': f'System not ready: {msg}'})
+                return
+        
+        truncated = False
+        answer_started = False
+        try:
+            for event in rag_system.query_stream(user_message):
+                if event['type'] == 'context':
+                    yield sse({
+                        'sources': event['sources'],
+                        'similarity_scores': format_similarity_scores(event['context_used'])
+                    })
+                elif event['type'] == 'truncated':
+                    truncated = True
+                else:
+                    answer_started = True
+                    yield sse({'delta': event['text']})
+            
+            yield sse({
+                'done': True,
+                'truncated': truncated,
+                'timestamp': datetime.now().strftime('%H:%M')
+            })
+            
+        except Exception as e:
+            yield sse({
+                'error': True,
+                # Tells the page to keep the text already shown and mark it as cut off
+                'truncated': answer_started,
+                'message': f'Error processing your message: {str(e)}'
+            })
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/status')
 def status():
-    """Check system status"""
+    """Check system status (without initializing the system)"""
     global rag_system
     
     if rag_system is None:
-        success, msg = initialize_rag()
         return jsonify({
-            'ready': success,
-            'message': msg
+            'ready': False,
+            'initialized': False,
+            'error': rag_init_error is not None,
+            'message': rag_init_error or 'System will initialize on the first question'
         })
     
     return jsonify({
         'ready': True,
+        'initialized': True,
         'message': 'System ready'
     })
 
 @app.route('/api/sample-questions')
 def sample_questions():
     """Get sample questions for the UI"""
-    questions = [
-        "What is FPG Berhad and what do they do?",
-        "Tell me about FPG's M&A advisory services",
-        "What is FPG's global presence?",
-        "What are FPG's investment sectors?",
-        "Tell me about FPG's vision and mission",
-        "What successful M&A cases has FPG completed?"
-    ]
-    
     return jsonify({
-        'questions': questions
+        'questions': SAMPLE_QUESTIONS
     })
 
 if __name__ == '__main__':
     print("🚀 Starting FPG Berhad RAG Chatbot...")
-    print("🔧 Initializing system...")
     
-    # Pre-initialize RAG system
-    success, msg = initialize_rag()
-    if success:
-        print(f"✅ {msg}")
-        print("🌐 Starting web server...")
-        print("📱 Open http://localhost:5000 in your browser")
-        print("🛑 Press Ctrl+C to stop")
+    # Pre-initialize RAG system only when asked to (PREWARM=1)
+    if os.getenv('PREWARM') == '1':
+        print("🔧 Initializing system...")
+        success, msg = initialize_rag()
+        if success:
+            print(f"✅ {msg}")
+        else:
+            print(f"❌ {msg}")
+            print("⚠️  Starting server anyway - system will initialize on first request")
     else:
-        print(f"❌ {msg}")
-        print("⚠️  Starting server anyway - system will initialize on first request")
+        print("💤 RAG system will initialize on first request (set PREWARM=1 to load it now)")
+    
+    print("🌐 Starting web server...")
+    print("📱 Open http://localhost:5000 in your browser")
+    print("🛑 Press Ctrl+C to stop")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Development server only; use gunicorn with wsgi.py in production
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', host='0.0.0.0', port=5000)
\ No newline at end of file
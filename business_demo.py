@@ -4,8 +4,24 @@ Business-Specific RAG Test Script
 Demonstrates the RAG pipeline with business-relevant queries for FPG Berhad content.
 """
 
+import numpy as np
 import chromadb
-from sentence_transformers import SentenceTransformer
+from encoder_utils import load_sentence_transformer
+from retrieval_utils import collection_space, distance_to_similarity
+
+
+# Business-specific queries for FPG Berhad content
+BUSINESS_QUERIES = [
+    "What is FPG Berhad's vision and mission?",
+    "Tell me about FPG's M&A advisory services",
+    "What are FPG's investment portfolio sectors?",
+    "Where does FPG have global presence?",
+    "What are FPG's successful M&A transactions?",
+    "Tell me about FPG's team and leadership",
+    "What are FPG's fees for M&A services?",
+    "What is FPG's privacy policy?",
+    "Tell me about FPG's career opportunities"
+]
 
 
 def test_business_queries():
@@ -20,56 +36,43 @@ def test_business_queries():
     print("Loading model and connecting to database...")
     
     # Load model and connect to ChromaDB
-    model = SentenceTransformer(MODEL_NAME)
+    model = load_sentence_transformer(MODEL_NAME)
     chroma_client = chromadb.PersistentClient(path=CHROMA_STORE_DIR)
     collection = chroma_client.get_collection(COLLECTION_NAME)
     
     print(f"Connected to collection with {collection.count()} documents")
     
-    # Business-specific queries for FPG Berhad content
-    business_queries = [
-        "What is FPG Berhad's vision and mission?",
-        "Tell me about FPG's M&A advisory services",
-        "What are FPG's investment portfolio sectors?",
-        "Where does FPG have global presence?",
-        "What are FPG's successful M&A transactions?",
-        "Tell me about FPG's team and leadership",
-        "What are FPG's fees for M&A services?",
-        "What is FPG's privacy policy?",
-        "Tell me about FPG's career opportunities"
-    ]
+    # Encode all queries in one batch and search the collection once
+    query_embeddings = model.encode(BUSINESS_QUERIES, batch_size=64, convert_to_numpy=True,
+                                    normalize_embeddings=True, show_progress_bar=False)
+    results = collection.query(
+        query_embeddings=query_embeddings,
+        n_results=2,  # Show top 2 results for each query
+        include=['documents', 'metadatas', 'distances']
+    )
     
-    for i, query in enumerate(business_queries, 1):
+    space = collection_space(collection)
+    for i, query in enumerate(BUSINESS_QUERIES, 1):
         print(f"\n{'='*70}")
         print(f"BUSINESS QUERY {i}: {query}")
         print('='*70)
         
-        # Generate query embedding
-        query_embedding = model.encode([query], convert_to_tensor=False)
-        
-        # Search the collection
-        results = collection.query(
-            query_embeddings=query_embedding.tolist(),
-            n_results=2,  # Show top 2 results for each query
-            include=['documents', 'metadatas', 'distances']
-        )
-        
-        if not results['documents'] or not results['documents'][0]:
+        if not results['documents'] or not results['documents'][i-1]:
             print("No results found.")
             continue
         
-        documents = results['documents'][0]
-        metadatas = results['metadatas'][0]
-        distances = results['distances'][0]
+        documents = results['documents'][i-1]
+        metadatas = results['metadatas'][i-1]
+        scores = distance_to_similarity(np.asarray(results['distances'][i-1]), space)
         
-        for j, (doc, metadata, distance) in enumerate(zip(documents, metadatas, distances)):
+        for j, (doc, metadata, score) in enumerate(zip(documents, metadatas, scores)):
             print(f"\n--- RESULT {j+1} ---")
             print(f"Source: {metadata.get('filename', 'Unknown').replace('.json', '').replace('_', ' ').title()}")
-            print(f"Similarity: {1 - distance:.4f}")
+            print(f"Similarity: {score:.4f}")
             print("Content:")
             
             # Show first 400 characters with better formatting
-            content = doc.replace(" | ", "\n• ").replace(": ", ": ")
+            content = doc.replace(" | ", "\n• ")
             if len(content) > 400:
                 print(f"{content[:400]}...")
             else:
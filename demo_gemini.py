@@ -5,9 +5,17 @@ Tests the enhanced system with sample queries
 """
 
 import os
+import threading
 from dotenv import load_dotenv
 from rag_gemini import RAGWithGemini
 
+# Demo queries
+DEMO_QUESTIONS = [
+    "What is FPG Berhad and what do they do?",
+    "Tell me about FPG's M&A advisory services",
+    "What is FPG's global presence?"
+]
+
 
 def demo_gemini_rag():
     """Demonstrate RAG + Gemini with business queries"""
@@ -35,20 +43,25 @@ def demo_gemini_rag():
         print(f"❌ Failed to initialize: {e}")
         return
     
-    # Demo queries
-    demo_questions = [
-        "What is FPG Berhad and what do they do?",
-        "Tell me about FPG's M&A advisory services",
-        "What is FPG's global presence?"
-    ]
+    # Results of the next question, computed while the user reads the current answer
+    prefetched = {}
+    prefetch_thread = None
+    
+    def prefetch(index):
+        # Quiet, so the background query's progress output stays out of the demo
+        # transcript (redirecting sys.stdout would also swallow the input() prompt)
+        prefetched[index] = rag.query(DEMO_QUESTIONS[index], verbose=False)
     
-    for i, question in enumerate(demo_questions, 1):
+    for i, question in enumerate(DEMO_QUESTIONS, 1):
+        if prefetch_thread is not None:
+            prefetch_thread.join()
+        
         print(f"\n{'='*70}")
         print(f"DEMO QUERY {i}/3: {question}")
         print(f"{'='*70}")
         
-        # Process query
-        result = rag.query(question)
+        # Process query (unless it was already prefetched)
+        result = prefetched.pop(i - 1, None) or rag.query(question)
         
         # Display formatted result
         print(f"\n🤖 GEMINI ANSWER:")
@@ -61,7 +74,9 @@ def demo_gemini_rag():
             print(f"{j}. {source} (Similarity: {similarity:.3f})")
         
         # Wait for user to continue (except last question)
-        if i < len(demo_questions):
+        if i < len(DEMO_QUESTIONS):
+            prefetch_thread = threading.Thread(target=prefetch, args=(i,), daemon=True)
+            prefetch_thread.start()
             input(f"\n⏭️  Press Enter to continue to demo query {i+1}...")
     
     print(f"\n{'='*70}")
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Encoder Utilities
+Shared loading of the sentence-transformer encoder used for indexing and querying.
+"""
+
+import math
+import os
+from pathlib import Path
+from typing import Optional
+
+import torch
+from sentence_transformers import SentenceTransformer
+
+# ONNX exports published alongside the sentence-transformers hub models
+DEFAULT_ONNX_FILE_GPU = "onnx/model_O4.onnx"
+DEFAULT_ONNX_FILE_CPU = "onnx/model_qint8_avx512_vnni.onnx"
+
+
+def _cgroup_cpu_limit() -> Optional[float]:
+    """CPU quota of the container (e.g. docker --cpus) in CPUs, or None if unlimited/unknown"""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def _threads_per_core() -> int:
+    """SMT siblings per physical core (2 with hyperthreading), 1 if unknown"""
+    try:
+        with open('/sys/devices/system/cpu/cpu0/topology/thread_siblings_list') as f:
+            siblings = 0
+            for span in f.read().strip().split(','):
+                first, _, last = span.partition('-')
+                siblings += int(last or first) - int(first) + 1
+        return max(siblings, 1)
+    except (OSError, ValueError):
+        return 1
+
+
+def available_cpus() -> int:
+    """Logical CPUs this process may use: affinity/cpuset limits and the cgroup CPU quota"""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, math.ceil(limit))
+    return max(cpus, 1)
+
+
+def available_physical_cores() -> int:
+    """Physical cores this process may use; SMT siblings don't speed up GEMMs"""
+    return max(available_cpus() // _threads_per_core(), 1)
+
+
+def configure_torch_inference() -> None:
+    """
+    Size torch's intra-op pool to the physical cores this process may use and
+    disable autograd globally.
+    
+    torch defaults to the host's physical core count, which can be too low
+    when a container runtime pins a single thread, or too high under a cgroup
+    quota. The pool is raised to the usable core count (unless OMP_NUM_THREADS
+    sets it explicitly) and never left above it.
+    """
+    cores = available_physical_cores()
+    threads = torch.get_num_threads()
+    if threads > cores or (threads < cores and 'OMP_NUM_THREADS' not in os.environ):
+        torch.set_num_threads(cores)
+    torch.set_grad_enabled(False)
+
+
+def load_sentence_transformer(model_name: str, backend: Optional[str] = None) -> SentenceTransformer:
+    """
+    Load a sentence-transformer on the fastest available device.
+    
+    The backend comes from ENCODER_BACKEND unless given: 'torch' (default)
+    uses CUDA in fp16 when a GPU is present and fp32 on CPU (int8 with
+    ENCODER_QUANTIZE=int8); 'onnx' runs an
+    ONNX Runtime export (ENCODER_ONNX_FILE, defaulting to the O4-optimized
+    graph on GPU and the int8 VNNI build on CPU); 'openvino' uses OpenVINO.
+    
+    Args:
+        model_name: Sentence-transformer model name or path
+        backend: Inference backend, overriding ENCODER_BACKEND
+        
+    Returns:
+        The loaded model
+    """
+    backend = backend or os.getenv('ENCODER_BACKEND', 'torch')
+    use_cuda = torch.cuda.is_available()
+    
+    if backend == 'onnx':
+        # Fused LayerNorm/GELU/attention kernels and constant-folded graph
+        file_name = _onnx_file_name(use_cuda)
+        provider = "CUDAExecutionProvider" if use_cuda else "CPUExecutionProvider"
+        model = SentenceTransformer(model_name, backend="onnx",
+                                    model_kwargs={"file_name": file_name, "provider": provider})
+    elif backend == 'openvino':
+        model = SentenceTransformer(model_name, backend="openvino")
+    else:
+        device = "cuda" if use_cuda else "cpu"
+        model = SentenceTransformer(model_name, device=device)
+        if device == "cuda":
+            # fp16 uses tensor cores and halves the bytes moved per layer
+            model.half()
+        elif os.getenv('ENCODER_QUANTIZE') == 'int8':
+            quantize_int8(model)
+    
+    ensure_fast_tokenizer(model)
+    return model
+
+
+def _onnx_file_name(use_cuda: bool) -> str:
+    """ONNX export to load: ENCODER_ONNX_FILE, else the default for the device"""
+    return os.getenv('ENCODER_ONNX_FILE') or \
+        (DEFAULT_ONNX_FILE_GPU if use_cuda else DEFAULT_ONNX_FILE_CPU)
+
+
+def encoder_variant(backend: Optional[str] = None) -> str:
+    """
+    Label of the backend and precision load_sentence_transformer would use,
+    e.g. 'torch-fp16', 'torch-int8' or 'onnx-model_qint8_avx512_vnni'.
+    
+    Embeddings differ slightly between variants, so anything caching them
+    should keep variants apart by this label.
+    
+    Args:
+        backend: Inference backend, overriding ENCODER_BACKEND
+        
+    Returns:
+        A filename-safe label
+    """
+    backend = backend or os.getenv('ENCODER_BACKEND', 'torch')
+    use_cuda = torch.cuda.is_available()
+    
+    if backend == 'onnx':
+        return f"onnx-{Path(_onnx_file_name(use_cuda)).stem}"
+    if backend == 'openvino':
+        return 'openvino'
+    if use_cuda:
+        return 'torch-fp16'
+    if os.getenv('ENCODER_QUANTIZE') == 'int8':
+        return 'torch-int8'
+    return 'torch-fp32'
+
+
+def ensure_fast_tokenizer(model: SentenceTransformer) -> None:
+    """
+    Swap in the Rust (PreTrainedTokenizerFast) tokenizer if the model loaded
+    the slow pure-Python one, which is several times slower per encode.
+    """
+    if getattr(model.tokenizer, 'is_fast', True):
+        return
+    
+    from transformers import AutoTokenizer
+    model.tokenizer = AutoTokenizer.from_pretrained(model.tokenizer.name_or_path, use_fast=True)
+
+
+def quantize_int8(model: SentenceTransformer) -> None:
+    """
+    Dynamically quantize the transformer's Linear layers to int8 in place.
+    
+    Weights are stored as int8 and activations quantized on the fly, so the
+    matmuls run on int8 dot-product (VNNI) kernels on CPUs that have them.
+    """
+    transformer = model[0]
+    transformer.auto_model = torch.ao.quantization.quantize_dynamic(
+        transformer.auto_model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def warm_up(model: SentenceTransformer) -> None:
+    """Run a throwaway encode so one-time initialization isn't paid by the first real query"""
+    # Two inputs so the batched (padded) path is initialized too, not just batch size 1
+    with torch.inference_mode():
+        model.encode(["warmup"] * 2, convert_to_numpy=True, show_progress_bar=False)
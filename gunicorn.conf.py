@@ -0,0 +1,24 @@
+"""
+Gunicorn settings for the chatbot.
+Run with: gunicorn wsgi:app
+"""
+
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+
+# Load the app (and the encoder) in the master so workers share its memory
+preload_app = True
+workers = int(os.getenv('WEB_CONCURRENCY', '4'))
+worker_class = 'gthread'
+threads = 8
+timeout = 120
+
+
+def post_fork(server, worker):
+    """Give each worker its own Gemini and ChromaDB connections"""
+    import app as chatbot
+    
+    # gRPC channels and SQLite handles must not be shared across a fork
+    if chatbot.rag_system is not None:
+        chatbot.rag_system.reconnect()
@@ -5,14 +5,15 @@ Quick test of the improved RAG system
 
 from rag_gemini import RAGWithGemini
 
+TEST_QUESTION = "What is FPG Berhad and what do they do?"
+
 def quick_test():
     try:
         print("🚀 Testing improved RAG system...")
         rag = RAGWithGemini()
         
         # Test with a single question
-        question = "What is FPG Berhad and what do they do?"
-        result = rag.query(question)
+        result = rag.query(TEST_QUESTION)
         
         print(f"\n🤖 ANSWER:")
         print("-" * 50)
@@ -5,11 +5,111 @@ Combines ChromaDB similarity search with Google Gemini for intelligent answers.
 """
 
 import os
+import re
+import json
+import queue
+import atexit
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np
 import chromadb
+from chromadb.api.client import SharedSystemClient
 import google.generativeai as genai
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
-from typing import List, Dict, Any
+from retrieval_utils import collection_space, distance_to_similarity, split_sections
+from encoder_utils import encoder_variant, load_sentence_transformer
+from typing import List, Dict, Any, Optional, Tuple, Iterator, Generator
+
+try:
+    import hnswlib
+except ImportError:  # Semantic cache falls back to brute-force NumPy search
+    hnswlib = None
+
+try:
+    import fcntl
+except ImportError:  # Windows; only single-process use there
+    fcntl = None
+
+# Below this many cached queries a brute-force dot product beats the ANN index
+CACHE_ANN_MIN_ENTRIES = 256
+CACHE_INDEX_INITIAL_CAPACITY = 10_000
+CACHE_INITIAL_CAPACITY = 1024  # Rows preallocated for cached query embeddings; doubles as needed
+# Beyond this the oldest entries are overwritten. Each entry holds an answer
+# (a few KB) plus a 3 KB embedding, so this bounds the cache to well under a GB
+CACHE_MAX_ENTRIES = 100_000
+ANSWER_CACHE_SIZE = 512
+# An answer cached for a document set is only reused for a question this close
+# (cosine) to the one it was generated for; different questions about the same
+# documents need their own answer
+ANSWER_CACHE_MIN_SIMILARITY = 0.9
+EMBED_CACHE_SIZE = 4096
+
+# Static instruction preamble, set once on the answer model rather than in every prompt.
+# It is far below Gemini's minimum size for context caching (1024+ tokens)
+SYSTEM_INSTRUCTION = """You are an AI assistant specializing in FPG Berhad, an investment holding company with M&A advisory services.
+
+Based on the documents provided with each question, provide a comprehensive and well-structured answer to the user's question.
+
+Please provide a detailed, professional response that:
+1. Directly answers the question
+2. Uses bullet points or structured format when appropriate
+3. Cites information from the documents
+4. Maintains a business-professional tone"""
+
+# Use more conservative settings to avoid token issues
+ANSWER_GENERATION_CONFIG = {
+    'temperature': 0.4,  # Balanced creativity
+    'max_output_tokens': 800,  # Reasonable length
+    'top_p': 0.8,
+    'top_k': 40
+}
+# Settings for the retry with a single, truncated document
+SHORT_GENERATION_CONFIG = {
+    'temperature': 0.3,
+    'max_output_tokens': 400,
+}
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+# Section keywords that make a part worth including in a fallback answer
+_SUMMARY_KEYWORDS = frozenset(['vision', 'mission', 'services', 'advisory', 'founded', 'company'])
+
+# Micro-batching of concurrent answer requests (see BatchScheduler)
+BATCH_WINDOW_SECONDS = 0.05
+MAX_BATCH = 8
+BATCH_MAX_OUTPUT_TOKENS = 8192
+_BATCH_ANSWER_RE = re.compile(r'^\s*#{2,}\s*ANSWER\s+(\d+)\s*:?\s*$', re.IGNORECASE | re.MULTILINE)
+
+# Unit-norm float32 output, so cosine similarity is a plain dot product
+ENCODE_KWARGS = {
+    'batch_size': 64,
+    'convert_to_numpy': True,
+    'normalize_embeddings': True,
+    'show_progress_bar': False,
+}
+
+DEFAULT_MODEL_NAME = "all-mpnet-base-v2"  # Upgraded for better quality
+DEMO_QUERIES_PATH = "./demo_queries.npz"
+
+
+def normalize_query(query: str) -> str:
+    """Canonical form of a query used for embedding lookups"""
+    return query.strip().lower()
+
+
+def query_key(query: str) -> bytes:
+    """Stable key of a normalized query in the precomputed embedding store"""
+    return hashlib.sha1(query.encode('utf-8')).digest()
 
 
 class RAGWithGemini:
@@ -17,7 +117,10 @@ class RAGWithGemini:
     
     def __init__(self, chroma_store_dir: str = "./chroma_store", 
                  collection_name: str = "company_docs",
-                 model_name: str = "all-mpnet-base-v2"):  # Upgraded for better quality
+                 model_name: str = DEFAULT_MODEL_NAME,
+                 static_embeddings_path: str = DEMO_QUERIES_PATH,
+                 cache_path: str = "./query_cache",
+                 cache_threshold: float = 0.95):
         """Initialize the RAG system"""
         
         # Load environment variables
@@ -26,12 +129,45 @@ class RAGWithGemini:
         self.chroma_store_dir = chroma_store_dir
         self.collection_name = collection_name
         self.model_name = model_name
+        # Backend/precision the encoder loads with; fp16, int8, ONNX and fp32
+        # vectors differ slightly, so stored embeddings must come from the same one
+        self.encoder_variant = encoder_variant()
         self.top_k = 3
         
+        # The encoder is loaded on first use; canonical demo questions are
+        # answered from precomputed embeddings and may never need it
+        self._encoder = None
+        self._encoder_lock = threading.Lock()
+        # Per-instance memo so the cache neither keys on nor keeps alive self
+        self._embed = lru_cache(maxsize=EMBED_CACHE_SIZE)(self._embed_uncached)
+        self.static_embeddings_path = static_embeddings_path
+        self.static_embs: Dict[bytes, np.ndarray] = {}
+        
+        # Semantic cache: L2-normalized query embeddings and their results
+        self.cache_path = cache_path
+        self.cache_threshold = cache_threshold
+        self._cache_buf: np.ndarray = np.empty((0, 0), dtype=np.float32)  # Rows beyond len(cache_entries) are spare
+        self.cache_entries: List[Dict[str, Any]] = []
+        self._cache_evict_next = 0  # Oldest slot, overwritten next once CACHE_MAX_ENTRIES is reached
+        self.cache_index = None  # HNSW index over cache_embs, built on first insert
+        # Second-level cache: answers and the embedding of the question they
+        # answered, keyed on the set of retrieved document ids
+        self.answer_cache: "OrderedDict[bytes, Tuple[str, np.ndarray]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_dirty = False
+        
+        # Optional micro-batcher for concurrent callers (see enable_batching)
+        self.batcher: Optional["BatchScheduler"] = None
+        
         # Initialize components
         self._setup_gemini()
-        self._load_sentence_transformer()
+        self._load_static_embeddings()
         self._connect_chromadb()
+        self._load_semantic_cache()
+        if hnswlib is None:
+            print("⚠️  hnswlib not installed - semantic cache uses brute-force search "
+                  "(install chroma-hnswlib, normally pulled in by chromadb)")
+        atexit.register(self.save_cache)
     
     def _setup_gemini(self):
         """Setup Google Gemini API"""
@@ -52,12 +188,55 @@ class RAGWithGemini:
         }
         
         print(f"✓ Gemini configured with model: {self.gemini_model}")
+        
+        # Main answer model and the model for the short-context retry; built
+        # once and reused across requests
+        self.gm_main = genai.GenerativeModel(
+            model_name=self.gemini_model,
+            system_instruction=SYSTEM_INSTRUCTION,
+            generation_config=ANSWER_GENERATION_CONFIG,
+            safety_settings=SAFETY_SETTINGS
+        )
+        self.gm_short = genai.GenerativeModel(
+            model_name=self.gemini_model,
+            generation_config=SHORT_GENERATION_CONFIG
+        )
     
     def _load_sentence_transformer(self):
         """Load the sentence transformer model"""
-        print(f"Loading sentence transformer: {self.model_name}...")
-        self.encoder = SentenceTransformer(self.model_name)
-        print("✓ Sentence transformer loaded")
+        backend = os.getenv('ENCODER_BACKEND', 'torch')
+        print(f"Loading sentence transformer: {self.model_name} ({backend})...")
+        self._encoder = load_sentence_transformer(self.model_name, backend)
+        print(f"✓ Sentence transformer loaded on {self._encoder.device}")
+    
+    @property
+    def encoder(self) -> SentenceTransformer:
+        """Sentence transformer, loaded lazily on first access"""
+        if self._encoder is None:
+            with self._encoder_lock:
+                if self._encoder is None:
+                    self._load_sentence_transformer()
+        return self._encoder
+    
+    def _load_static_embeddings(self):
+        """Load precomputed embeddings for the canonical demo questions"""
+        if not os.path.exists(self.static_embeddings_path):
+            return
+        
+        try:
+            with np.load(self.static_embeddings_path) as data:
+                if str(data['model_name']) != self.model_name or \
+                   'encoder_variant' not in data.files or \
+                   str(data['encoder_variant']) != self.encoder_variant:
+                    print("⚠️  Precomputed demo embeddings use a different model or encoder backend - ignoring them")
+                    return
+                self.static_embs = {
+                    bytes.fromhex(key): data[key].astype(np.float32)
+                    for key in data.files if key not in ('model_name', 'encoder_variant')
+                }
+            print(f"✓ Loaded {len(self.static_embs)} precomputed query embeddings")
+        except Exception as e:
+            print(f"⚠️  Failed to load precomputed query embeddings: {e}")
     
     def _connect_chromadb(self):
         """Connect to ChromaDB collection"""
@@ -65,6 +244,7 @@ class RAGWithGemini:
         try:
             self.chroma_client = chromadb.PersistentClient(path=self.chroma_store_dir)
             self.collection = self.chroma_client.get_collection(self.collection_name)
+            self.distance_space = collection_space(self.collection)
             
             doc_count = self.collection.count()
             print(f"✓ Connected to '{self.collection_name}' with {doc_count} documents")
@@ -75,15 +255,289 @@ class RAGWithGemini:
         except Exception as e:
             raise ValueError(f"Failed to connect to ChromaDB: {e}")
     
-    def retrieve_context(self, query: str) -> List[Dict[str, Any]]:
+    def load_encoder(self):
+        """Load the sentence transformer now instead of on first query"""
+        return self.encoder
+    
+    def reconnect(self):
+        """Recreate the Gemini and ChromaDB clients, e.g. in a freshly forked worker"""
+        self._setup_gemini()
+        # PersistentClient(path) reuses the System cached for that path, which a
+        # forked worker inherits along with the parent's SQLite connections;
+        # drop it so the new client opens its own
+        SharedSystemClient.clear_system_cache()
+        self._connect_chromadb()
+    
+    def enable_batching(self, max_batch: int = MAX_BATCH,
+                        window: float = BATCH_WINDOW_SECONDS):
+        """Group answer generation of concurrent query() calls into shared Gemini requests"""
+        self.batcher = BatchScheduler(self, max_batch=max_batch, window=window)
+    
+    @property
+    def cache_embs(self) -> np.ndarray:
+        """Embeddings of the cached queries, row i belonging to cache_entries[i]"""
+        return self._cache_buf[:len(self.cache_entries)]
+    
+    def _grow_cache(self, dim: int):
+        """Double the preallocated embedding buffer (up to CACHE_MAX_ENTRIES rows)"""
+        capacity = min(max(CACHE_INITIAL_CAPACITY, 2 * len(self._cache_buf)), CACHE_MAX_ENTRIES)
+        buf = np.empty((capacity, dim), dtype=np.float32)
+        buf[:len(self.cache_entries)] = self.cache_embs
+        self._cache_buf = buf
+    
+    @contextmanager
+    def _cache_file_lock(self):
+        """Exclusive lock on the cache files, shared by every process using them
+        (e.g. gunicorn workers), so a reader never sees files from two writers"""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.cache_path}.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def _load_semantic_cache(self):
+        """Load the persisted semantic cache, if any"""
+        with self._cache_file_lock():
+            self._read_semantic_cache()
+    
+    def _read_semantic_cache(self):
+        """Read the cache files; callers hold the cache file lock"""
+        embs_file = f"{self.cache_path}.npz"
+        entries_file = f"{self.cache_path}.json"
+        if not (os.path.exists(embs_file) and os.path.exists(entries_file)):
+            return
+        
+        try:
+            with np.load(embs_file) as data:
+                if str(data['model_name']) != self.model_name or \
+                   'encoder_variant' not in data.files or \
+                   str(data['encoder_variant']) != self.encoder_variant:
+                    print("⚠️  Semantic cache was built with a different model or encoder backend - ignoring it")
+                    return
+                # Cached answers and contexts are only valid for the index they came from
+                if 'collection_id' not in data.files or \
+                   str(data['collection_id']) != str(self.collection.id) or \
+                   int(data['collection_count']) != self.collection.count():
+                    print("⚠️  Semantic cache was built against a different index - ignoring it")
+                    return
+                embs = data['embs'].astype(np.float32)
+                evict_next = int(data['evict_next']) if 'evict_next' in data.files else 0
+            with open(entries_file, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            
+            if len(entries) != len(embs):
+                print("⚠️  Semantic cache files are out of sync - ignoring them")
+                return
+            
+            self._cache_buf = embs
+            self.cache_entries = entries
+            self._cache_evict_next = evict_next
+            self._load_cache_index()
+            print(f"✓ Loaded semantic cache with {len(entries)} entries")
+        except Exception as e:
+            print(f"⚠️  Failed to load semantic cache: {e}")
+    
+    def _new_cache_index(self, dim: int, capacity: int):
+        """Create an empty cosine-space HNSW index for the semantic cache"""
+        index = hnswlib.Index(space='cosine', dim=dim)
+        index.init_index(max_elements=capacity, ef_construction=200, M=16)
+        index.set_ef(50)
+        return index
+    
+    def _load_cache_index(self):
+        """Load the persisted HNSW index, rebuilding it if missing or stale"""
+        if hnswlib is None or not self.cache_entries:
+            return
+        
+        count = len(self.cache_entries)
+        dim = self.cache_embs.shape[1]
+        capacity = min(max(CACHE_INDEX_INITIAL_CAPACITY, count * 2), CACHE_MAX_ENTRIES)
+        index_file = f"{self.cache_path}.hnsw"
+        
+        if os.path.exists(index_file):
+            try:
+                index = hnswlib.Index(space='cosine', dim=dim)
+                index.load_index(index_file, max_elements=capacity)
+                if index.get_current_count() == count:
+                    index.set_ef(50)
+                    self.cache_index = index
+                    return
+            except Exception as e:
+                print(f"⚠️  Failed to load semantic cache index: {e}")
+        
+        index = self._new_cache_index(dim, capacity)
+        index.add_items(self.cache_embs, np.arange(count))
+        self.cache_index = index
+    
+    def save_cache(self):
+        """Persist the semantic cache to disk (.npz embeddings + JSON results).
+        
+        Each file is written to a per-process temporary name and moved into
+        place with os.replace, under the cache file lock, so concurrent
+        workers exiting together leave one complete, consistent set of files
+        (the last writer's) rather than torn or mixed ones. Only the snapshot
+        is taken under the in-memory cache lock, not the slow JSON dump.
+        """
+        tmp_suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with self._cache_lock:
+            if not self._cache_dirty:
+                return
+            embs = self.cache_embs.copy()
+            entries = list(self.cache_entries)
+            evict_next = self._cache_evict_next
+            self._cache_dirty = False
+            try:
+                # hnswlib can't save while another thread adds items
+                if self.cache_index is not None:
+                    self.cache_index.save_index(f"{self.cache_path}.hnsw{tmp_suffix}")
+            except Exception as e:
+                self._cache_dirty = True
+                print(f"⚠️  Failed to save semantic cache: {e}")
+                return
+        
+        try:
+            with self._cache_file_lock():
+                with open(f"{self.cache_path}.npz{tmp_suffix}", 'wb') as f:
+                    np.savez(f,
+                             embs=embs,
+                             evict_next=np.array(evict_next),
+                             model_name=np.array(self.model_name),
+                             encoder_variant=np.array(self.encoder_variant),
+                             collection_id=np.array(str(self.collection.id)),
+                             collection_count=np.array(self.collection.count()))
+                with open(f"{self.cache_path}.json{tmp_suffix}", 'w', encoding='utf-8') as f:
+                    json.dump(entries, f)
+                
+                for ext in ('hnsw', 'json', 'npz'):
+                    if os.path.exists(f"{self.cache_path}.{ext}{tmp_suffix}"):
+                        os.replace(f"{self.cache_path}.{ext}{tmp_suffix}", f"{self.cache_path}.{ext}")
+        except Exception as e:
+            with self._cache_lock:
+                self._cache_dirty = True
+            print(f"⚠️  Failed to save semantic cache: {e}")
+    
+    def _cache_lookup(self, query_embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Return the cached result for the most similar past query, or None"""
+        with self._cache_lock:
+            if not self.cache_entries:
+                return None
+            
+            if self.cache_index is not None and \
+               self.cache_index.get_current_count() >= CACHE_ANN_MIN_ENTRIES:
+                labels, distances = self.cache_index.knn_query(query_embedding, k=1)
+                best = int(labels[0][0])
+                similarity = 1 - float(distances[0][0])
+            else:
+                sims = self.cache_embs @ query_embedding
+                best = int(np.argmax(sims))
+                similarity = float(sims[best])
+            
+            if similarity >= self.cache_threshold:
+                return self.cache_entries[best]
+        return None
+    
+    @staticmethod
+    def _cache_entry(question: str, answer: str, sources: List[str],
+                     context_docs: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Semantic cache entry for a result: the answer plus which documents it
+        came from, not their full text (which can be tens of KB per document)"""
+        return {
+            'question': question,
+            'answer': answer,
+            'sources': sources,
+            'context_used': [
+                {
+                    'doc_id': doc['doc_id'],
+                    'source': doc['source'],
+                    'record_id': doc['record_id'],
+                    'similarity_score': doc['similarity_score']
+                }
+                for doc in context_docs
+            ]
+        }
+    
+    def _cache_insert(self, query_embedding: np.ndarray, result: Dict[str, Any]):
+        """Add a query embedding and its result (see _cache_entry) to the semantic cache"""
+        with self._cache_lock:
+            count = len(self.cache_entries)
+            if count < CACHE_MAX_ENTRIES:
+                slot = count
+                if count == len(self._cache_buf):
+                    self._grow_cache(query_embedding.shape[0])
+                self.cache_entries.append(result)
+            else:
+                # Full: overwrite the oldest entry, in the array and in the index
+                slot = self._cache_evict_next
+                self._cache_evict_next = (slot + 1) % CACHE_MAX_ENTRIES
+                self.cache_entries[slot] = result
+            self._cache_buf[slot] = query_embedding
+            self._cache_dirty = True
+            
+            if hnswlib is None:
+                return
+            if self.cache_index is None:
+                self.cache_index = self._new_cache_index(
+                    query_embedding.shape[0], CACHE_INDEX_INITIAL_CAPACITY)
+            elif slot == self.cache_index.get_max_elements():
+                self.cache_index.resize_index(min(
+                    self.cache_index.get_max_elements() * 2, CACHE_MAX_ENTRIES))
+            # Adding an existing label replaces that element's vector
+            self.cache_index.add_items(query_embedding[np.newaxis, :], [slot])
+    
+    def _embed_uncached(self, query: str) -> bytes:
+        """Encode an already-normalized query (memoized per instance as _embed)"""
+        embedding = self.encoder.encode([query], **ENCODE_KWARGS)
+        return embedding[0].astype(np.float32).tobytes()
+    
+    @staticmethod
+    def _context_key(context_docs: List[Dict[str, Any]]) -> bytes:
+        """Order-independent key of the retrieved document set"""
+        ids = sorted(doc['doc_id'].encode('utf-8') for doc in context_docs)
+        return hashlib.blake2b(b'\0'.join(ids), digest_size=16).digest()
+    
+    def _answer_cache_get(self, ctx_key: bytes, query_embedding: np.ndarray) -> Optional[str]:
+        """Look up an answer previously generated for the same documents and a similar question"""
+        with self._cache_lock:
+            cached = self.answer_cache.get(ctx_key)
+            if cached is None:
+                return None
+            answer, question_embedding = cached
+            if float(question_embedding @ query_embedding) < ANSWER_CACHE_MIN_SIMILARITY:
+                return None
+            self.answer_cache.move_to_end(ctx_key)
+            return answer
+    
+    def _answer_cache_put(self, ctx_key: bytes, answer: str, query_embedding: np.ndarray):
+        """Remember an answer, evicting the least recently used beyond ANSWER_CACHE_SIZE"""
+        with self._cache_lock:
+            self.answer_cache[ctx_key] = (answer, query_embedding)
+            self.answer_cache.move_to_end(ctx_key)
+            if len(self.answer_cache) > ANSWER_CACHE_SIZE:
+                self.answer_cache.popitem(last=False)
+    
+    def embed_query(self, query: str) -> np.ndarray:
+        """Encode a query into an L2-normalized float32 embedding"""
+        # Case/whitespace variants of the same question share one cache slot
+        query = normalize_query(query)
+        static = self.static_embs.get(query_key(query))
+        if static is not None:
+            return static
+        return np.frombuffer(self._embed(query), dtype=np.float32)
+    
+    def retrieve_context(self, query: str, query_embedding: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
         """Retrieve relevant documents using similarity search"""
         
         # Generate query embedding
-        query_embedding = self.encoder.encode([query], convert_to_tensor=False)
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
         
         # Search the collection
         results = self.collection.query(
-            query_embeddings=query_embedding.tolist(),
+            query_embeddings=query_embedding[np.newaxis, :],
             n_results=self.top_k,
             include=['documents', 'metadatas', 'distances']
         )
@@ -92,26 +546,34 @@ class RAGWithGemini:
             return []
         
         # Format results
-        context_docs = []
+        ids = results['ids'][0]
         documents = results['documents'][0]
         metadatas = results['metadatas'][0]
-        distances = results['distances'][0]
+        scores = distance_to_similarity(np.asarray(results['distances'][0]),
+                                        self.distance_space).tolist()
         
-        for doc, metadata, distance in zip(documents, metadatas, distances):
-            context_docs.append({
+        context_docs = [
+            {
+                'doc_id': doc_id,
                 'content': doc,
                 'source': metadata.get('filename', 'Unknown'),
                 'record_id': metadata.get('record_id', 'N/A'),
-                'similarity_score': 1 - distance
-            })
+                'section_keywords': metadata.get('section_keywords'),
+                'similarity_score': score
+            }
+            for doc_id, doc, metadata, score in zip(ids, documents, metadatas, scores)
+        ]
         
         return context_docs
     
-    def generate_answer(self, query: str, context_docs: List[Dict[str, Any]]) -> str:
-        """Generate answer using Gemini based on retrieved context"""
-        
-        if not context_docs:
-            return "I couldn't find any relevant information to answer your question."
+    @staticmethod
+    def _document_sections(doc: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Keyword-tagged sections of a document, using the tags stored at index time when available"""
+        keywords = json.loads(doc['section_keywords']) if doc.get('section_keywords') else None
+        return split_sections(doc['content'], keywords)
+    
+    def _build_context_text(self, context_docs: List[Dict[str, Any]]) -> str:
+        """Render retrieved documents into the CONTEXT block of a prompt"""
         
         # Prepare context for Gemini - more selective content to avoid token issues
         context_text = ""
@@ -121,55 +583,47 @@ class RAGWithGemini:
             
             # If content is very long, try to extract key sections
             if len(content) > 2000:
-                # Split by separators and take key sections
-                parts = content.split(' | ')
+                # Take the sections tagged with key company keywords
                 key_parts = []
-                for part in parts:
-                    if any(keyword in part.lower() for keyword in ['vision', 'mission', 'services', 'advisory', 'investment', 'global', 'presence', 'founded', 'company']):
-                        key_parts.append(part)
+                for section in self._document_sections(doc):
+                    if section['kw']:
+                        key_parts.append(section['text'])
                     if len(' | '.join(key_parts)) > 1500:  # Limit total length
                         break
                 content = ' | '.join(key_parts) if key_parts else content[:1500]
             
             context_text += f"Document {i} (Source: {doc['source']}):\n{content}\n\n"
         
-        # Create prompt optimized for better Gemini responses
-        prompt = f"""You are an AI assistant specializing in FPG Berhad, an investment holding company with M&A advisory services.
-
-Based on the following documents, provide a comprehensive and well-structured answer to the user's question.
-
-CONTEXT:
+        return context_text
+    
+    def _build_prompt(self, query: str, context_docs: List[Dict[str, Any]]) -> str:
+        """Build the per-request prompt for a single question"""
+        
+        context_text = self._build_context_text(context_docs)
+        
+        # Only the variable part is sent; the instructions live in SYSTEM_INSTRUCTION
+        return f"""CONTEXT:
 {context_text}
 
 QUESTION: {query}
 
-Please provide a detailed, professional response that:
-1. Directly answers the question
-2. Uses bullet points or structured format when appropriate
-3. Cites information from the documents
-4. Maintains a business-professional tone
-
 ANSWER:"""
+    
+    def generate_answer(self, query: str, context_docs: List[Dict[str, Any]]) -> str:
+        """Generate answer using Gemini based on retrieved context"""
+        return self._generate_answer(query, context_docs)[0]
+    
+    def _generate_answer(self, query: str, context_docs: List[Dict[str, Any]]) -> Tuple[str, bool]:
+        """Generate an answer, also reporting whether it came from Gemini (True)
+        or from a local fallback (False) that must not be cached"""
+        
+        if not context_docs:
+            return "I couldn't find any relevant information to answer your question.", False
+        
+        prompt = self._build_prompt(query, context_docs)
 
         try:
-            # Use more conservative settings to avoid token issues
-            model = genai.GenerativeModel(
-                model_name=self.gemini_model,
-                generation_config={
-                    'temperature': 0.4,  # Balanced creativity
-                    'max_output_tokens': 800,  # Reasonable length
-                    'top_p': 0.8,
-                    'top_k': 40
-                },
-                safety_settings=[
-                    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-                ]
-            )
-            
-            response = model.generate_content(prompt)
+            response = self.gm_main.generate_content(prompt)
             
             # Better response handling
             if response.candidates and len(response.candidates) > 0:
@@ -177,31 +631,130 @@ ANSWER:"""
                 
                 # Try to get the text first
                 if hasattr(response, 'text') and response.text:
-                    return response.text
+                    return response.text, True
                 
                 # Check finish reason if no text
                 if hasattr(candidate, 'finish_reason'):
                     finish_reason = candidate.finish_reason
                     
                     if finish_reason == 1:  # STOP - success
-                        return response.text if response.text else "Response generated but empty."
+                        if response.text:
+                            return response.text, True
+                        return "Response generated but empty.", False
                     elif finish_reason == 2:  # MAX_TOKENS
                         # Try with shorter context
                         return self._retry_with_shorter_context(query, context_docs)
                     elif finish_reason == 3:  # SAFETY
-                        return self._format_structured_answer(context_docs, query)
+                        return self._format_structured_answer(context_docs, query), False
                     else:
-                        return self._format_structured_answer(context_docs, query)
+                        return self._format_structured_answer(context_docs, query), False
                 
-                return self._format_structured_answer(context_docs, query)
+                return self._format_structured_answer(context_docs, query), False
             
-            return self._format_structured_answer(context_docs, query)
+            return self._format_structured_answer(context_docs, query), False
             
         except Exception as e:
             print(f"⚠️  Gemini API error: {str(e)}")
-            return self._format_structured_answer(context_docs, query)
+            return self._format_structured_answer(context_docs, query), False
+    
+    def generate_answer_stream(self, query: str,
+                               context_docs: List[Dict[str, Any]]) -> Generator[Dict[str, Any], None, Optional[str]]:
+        """Generate an answer with Gemini, yielding {'type': 'delta'} events as text arrives.
+        
+        If Gemini stops mid-answer (API error, token limit or safety stop after
+        some text was sent), a final {'type': 'truncated'} event follows the
+        partial text.
+        
+        Returns the full answer if Gemini finished it cleanly (finish reason
+        STOP), or None if the stream broke off, hit the token limit or a
+        safety stop, or a local fallback was sent instead. Only the former
+        may be cached.
+        """
+        
+        if not context_docs:
+            yield {'type': 'delta',
+                   'text': "I couldn't find any relevant information to answer your question."}
+            return None
+        
+        prompt = self._build_prompt(query, context_docs)
+        chunks = []
+        finish_reason = None
+        
+        try:
+            for chunk in self.gm_main.generate_content(prompt, stream=True):
+                if chunk.candidates:
+                    # Set on the final chunk; earlier chunks report 0 (unspecified)
+                    finish_reason = chunk.candidates[0].finish_reason or finish_reason
+                try:
+                    text = chunk.text
+                except ValueError:  # Chunk without text parts, e.g. a safety stop
+                    continue
+                if text:
+                    chunks.append(text)
+                    yield {'type': 'delta', 'text': text}
+        except Exception as e:
+            print(f"⚠️  Gemini API error: {str(e)}")
+            finish_reason = None
+        
+        if not chunks:
+            yield {'type': 'delta', 'text': self._format_structured_answer(context_docs, query)}
+            return None
+        if finish_reason != 1:  # Anything but STOP leaves a partial answer
+            print(f"⚠️  Gemini stream ended early (finish reason {finish_reason}) - not caching")
+            yield {'type': 'truncated'}
+            return None
+        return ''.join(chunks)
+    
+    def generate_answers(self, items: List[Tuple[str, List[Dict[str, Any]]]]) -> List[Tuple[str, bool]]:
+        """Answer several (question, context_docs) pairs with a single Gemini call.
+        
+        Returns (answer, from_gemini) pairs in the order of items.
+        """
+        
+        if len(items) == 1:
+            return [self._generate_answer(*items[0])]
+        
+        sections = []
+        for n, (question, context_docs) in enumerate(items, 1):
+            sections.append(f"QUESTION {n}: {question}\n\nCONTEXT {n}:\n"
+                            f"{self._build_context_text(context_docs)}")
+        
+        prompt = (
+            "Answer each of the following questions using the provided contexts. "
+            "Use only the context with the same number as the question. "
+            "Start each answer on its own line with \"### ANSWER <number>\".\n\n"
+            + "\n".join(sections)
+        )
+        
+        answers: Dict[int, str] = {}
+        try:
+            response = self.gm_main.generate_content(prompt, generation_config={
+                **ANSWER_GENERATION_CONFIG,
+                'max_output_tokens': min(ANSWER_GENERATION_CONFIG['max_output_tokens'] * len(items),
+                                         BATCH_MAX_OUTPUT_TOKENS)
+            })
+            
+            # re.split with one capture group yields [preamble, n1, text1, n2, text2, ...]
+            parts = _BATCH_ANSWER_RE.split(response.text)
+            for number, text in zip(parts[1::2], parts[2::2]):
+                if text.strip():
+                    answers[int(number)] = text.strip()
+            
+            # Unless Gemini finished with STOP (e.g. it hit max_output_tokens), the
+            # last answer in the response may be cut off; answer that one on its own
+            if parts[1::2] and response.candidates[0].finish_reason != 1:
+                answers.pop(int(parts[1::2][-1]), None)
+        except Exception as e:
+            print(f"⚠️  Batched Gemini call failed, answering individually: {str(e)}")
+        
+        # Anything the batched response didn't cover is answered on its own
+        return [
+            (answers[n], True) if n in answers else self._generate_answer(question, context_docs)
+            for n, (question, context_docs) in enumerate(items, 1)
+        ]
     
-    def _retry_with_shorter_context(self, query: str, context_docs: List[Dict[str, Any]]) -> str:
+    def _retry_with_shorter_context(self, query: str,
+                                    context_docs: List[Dict[str, Any]]) -> Tuple[str, bool]:
         """Retry with shorter context when hitting token limits"""
         
         try:
@@ -215,49 +768,41 @@ Context: {short_content}
 
 Provide a clear, professional answer:"""
             
-            model = genai.GenerativeModel(
-                model_name=self.gemini_model,
-                generation_config={
-                    'temperature': 0.3,
-                    'max_output_tokens': 400,
-                }
-            )
-            
-            response = model.generate_content(prompt)
+            response = self.gm_short.generate_content(prompt)
             
             if response.text:
-                return response.text
+                return response.text, True
             
         except:
             pass
         
         # Final fallback
-        return self._format_structured_answer(context_docs, query)
+        return self._format_structured_answer(context_docs, query), False
     
     def _format_structured_answer(self, context_docs: List[Dict[str, Any]], query: str) -> str:
         """Format a structured answer when Gemini fails - but make it look professional"""
         
         top_doc = context_docs[0]
-        content = top_doc['content']
         
         # Create a more professional structured response
         answer = f"Based on the information from FPG Berhad's {top_doc['source'].replace('.json', '').replace('_', ' ').title()}:\n\n"
         
         # Try to extract key information relevant to the query
-        parts = content.split(' | ')
+        sections = self._document_sections(top_doc)
         
-        # Filter parts based on query keywords
-        query_keywords = query.lower().split()
+        # Filter parts based on query keywords (one compiled pattern for all of them)
+        query_keywords = [re.escape(keyword) for keyword in query.lower().split()]
+        query_re = re.compile('|'.join(query_keywords), re.IGNORECASE) if query_keywords else None
         relevant_parts = []
         
-        for part in parts[:8]:  # Limit to first 8 parts
-            if any(keyword in part.lower() for keyword in query_keywords) or \
-               any(keyword in part.lower() for keyword in ['vision', 'mission', 'services', 'advisory', 'founded', 'company']):
-                relevant_parts.append(part.strip())
+        for section in sections[:8]:  # Limit to first 8 parts
+            if _SUMMARY_KEYWORDS.intersection(section['kw']) or \
+               (query_re is not None and query_re.search(section['text'])):
+                relevant_parts.append(section['text'].strip())
         
         # If no keyword matches, take the first few parts
         if not relevant_parts:
-            relevant_parts = parts[:5]
+            relevant_parts = [section['text'] for section in sections[:5]]
         
         for part in relevant_parts:
             if part.strip() and ':' in part:
@@ -265,13 +810,26 @@ Provide a clear, professional answer:"""
         
         return answer
     
-    def query(self, question: str) -> Dict[str, Any]:
-        """Main query method that combines retrieval and generation"""
+    def query(self, question: str, verbose: bool = True) -> Dict[str, Any]:
+        """Main query method that combines retrieval and generation.
         
-        print(f"🔍 Searching for: '{question}'")
+        verbose=False suppresses the progress messages, e.g. for background prefetches.
+        """
+        
+        if verbose:
+            print(f"🔍 Searching for: '{question}'")
+        
+        query_embedding = self.embed_query(question)
+        
+        # Step 0: Answer paraphrased repeats straight from the semantic cache
+        cached = self._cache_lookup(query_embedding)
+        if cached is not None:
+            if verbose:
+                print("⚡ Semantic cache hit - skipping retrieval and generation")
+            return {**cached, 'question': question}
         
         # Step 1: Retrieve relevant documents
-        context_docs = self.retrieve_context(question)
+        context_docs = self.retrieve_context(question, query_embedding)
         
         if not context_docs:
             return {
@@ -281,18 +839,142 @@ Provide a clear, professional answer:"""
                 'context_used': []
             }
         
-        print(f"📄 Found {len(context_docs)} relevant documents")
+        if verbose:
+            print(f"📄 Found {len(context_docs)} relevant documents")
         
-        # Step 2: Generate answer with Gemini
-        print("🤖 Generating answer with Gemini...")
-        answer = self.generate_answer(question, context_docs)
+        # Step 2: Reuse the answer if these exact documents were answered from before
+        ctx_key = self._context_key(context_docs)
+        answer = self._answer_cache_get(ctx_key, query_embedding)
+        from_gemini = answer is not None
+        if from_gemini:
+            if verbose:
+                print("⚡ Same documents as a similar earlier question - reusing its answer")
+        else:
+            # Step 3: Generate answer with Gemini
+            if verbose:
+                print("🤖 Generating answer with Gemini...")
+            if self.batcher is not None:
+                answer, from_gemini = self.batcher.submit(question, context_docs).result()
+            else:
+                answer, from_gemini = self._generate_answer(question, context_docs)
+            # Fallbacks after an API error, quota or safety stop are not cached,
+            # so the next ask gets another chance at a real answer
+            if from_gemini:
+                self._answer_cache_put(ctx_key, answer, query_embedding)
         
-        return {
+        result = {
             'question': question,
             'answer': answer,
             'sources': [doc['source'] for doc in context_docs],
             'context_used': context_docs
         }
+        if from_gemini:
+            self._cache_insert(query_embedding, self._cache_entry(
+                question, answer, result['sources'], context_docs))
+        
+        return result
+    
+    def query_stream(self, question: str) -> Iterator[Dict[str, Any]]:
+        """Streaming variant of query().
+        
+        Yields a {'type': 'context'} event with the sources and retrieved
+        documents, followed by {'type': 'delta'} events carrying answer text
+        and, if Gemini stopped mid-answer, a {'type': 'truncated'} event.
+        """
+        
+        print(f"🔍 Searching for: '{question}'")
+        
+        query_embedding = self.embed_query(question)
+        
+        cached = self._cache_lookup(query_embedding)
+        if cached is not None:
+            print("⚡ Semantic cache hit - skipping retrieval and generation")
+            yield {'type': 'context', 'sources': cached['sources'],
+                   'context_used': cached['context_used']}
+            yield {'type': 'delta', 'text': cached['answer']}
+            return
+        
+        context_docs = self.retrieve_context(question, query_embedding)
+        sources = [doc['source'] for doc in context_docs]
+        yield {'type': 'context', 'sources': sources, 'context_used': context_docs}
+        
+        if not context_docs:
+            yield {'type': 'delta',
+                   'text': "I couldn't find any relevant information to answer your question."}
+            return
+        
+        print(f"📄 Found {len(context_docs)} relevant documents")
+        
+        ctx_key = self._context_key(context_docs)
+        answer = self._answer_cache_get(ctx_key, query_embedding)
+        if answer is not None:
+            print("⚡ Same documents as a similar earlier question - reusing its answer")
+            yield {'type': 'delta', 'text': answer}
+        else:
+            print("🤖 Streaming answer from Gemini...")
+            answer = yield from self.generate_answer_stream(question, context_docs)
+            # Fallbacks are not cached (see query())
+            if answer is None:
+                return
+            self._answer_cache_put(ctx_key, answer, query_embedding)
+        
+        self._cache_insert(query_embedding, self._cache_entry(question, answer, sources, context_docs))
+
+
+class BatchScheduler:
+    """Collects concurrent answer requests for a short window and sends them to Gemini together"""
+    
+    def __init__(self, rag: RAGWithGemini, max_batch: int = MAX_BATCH,
+                 window: float = BATCH_WINDOW_SECONDS, max_in_flight: int = 4):
+        self.rag = rag
+        self.max_batch = max_batch
+        self.window = window
+        self._queue: "queue.Queue[Tuple[str, List[Dict[str, Any]], Future]]" = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+    
+    def submit(self, question: str, context_docs: List[Dict[str, Any]]) -> Future:
+        """Queue a question for answering; the future resolves to (answer, from_gemini)"""
+        future: Future = Future()
+        self._ensure_worker()
+        self._queue.put((question, context_docs, future))
+        return future
+    
+    def _ensure_worker(self):
+        """Start the collector thread on first use"""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._collect, daemon=True)
+                self._worker.start()
+    
+    def _collect(self):
+        """Pop up to max_batch requests within the window and dispatch them"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Dispatch off-thread so the next batch can be collected meanwhile
+            self._executor.submit(self._dispatch, batch)
+    
+    def _dispatch(self, batch: List[Tuple[str, List[Dict[str, Any]], Future]]):
+        """Run one batched generation and resolve the waiting futures"""
+        try:
+            answers = self.rag.generate_answers([(q, docs) for q, docs, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        
+        for (_, _, future), answer in zip(batch, answers):
+            future.set_result(answer)
 
 
 def format_response(result: Dict[str, Any]) -> None:
@@ -4,63 +4,116 @@ RAG Indexing Script
 Loads JSON files from ./data/, processes them, and stores in ChromaDB with embeddings.
 """
 
+import hashlib
 import json
-import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import Iterator, List, Dict, Any
+import numpy as np
+import orjson
+import torch
 import chromadb
-from sentence_transformers import SentenceTransformer
+from encoder_utils import available_cpus, configure_torch_inference, encoder_variant, load_sentence_transformer
+from retrieval_utils import section_keywords
 
 
-def load_json_files(data_dir: str) -> List[Dict[str, Any]]:
+# Minimum number of JSON files before loading is spread over worker processes
+PARALLEL_MIN_FILES = 32
+
+# Characters kept per token of the model's max_seq_length when clipping text
+# for the encoder. Comfortably above the ~4 chars/token of English WordPiece,
+# so clipped text still fills the window and the embedding is unchanged
+ENCODE_CHARS_PER_TOKEN = 6
+
+
+def iter_json_records(json_file: Path) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the records of one JSON file.
+    Each record in the file becomes a separate document.
+    
+    Yields:
+        Dictionaries containing document data and metadata, one at a time
+    """
+    with open(json_file, 'rb') as f:
+        data = orjson.loads(f.read())
+    
+    # Handle both single objects and arrays
+    if isinstance(data, list):
+        for i, record in enumerate(data):
+            yield {
+                'content': record,
+                'filename': json_file.name,
+                'record_id': i
+            }
+    else:
+        # Single object
+        yield {
+            'content': data,
+            'filename': json_file.name,
+            'record_id': 0
+        }
+
+
+def flatten_json_file(json_file: Path) -> List[Dict[str, Any]]:
     """
-    Load all JSON files from the data directory.
-    Each record in each file becomes a separate document.
+    Parse one JSON file and flatten each record to text.
+    Top-level so it can run in a worker process.
     
     Returns:
-        List of dictionaries containing document data and metadata
+        List of dictionaries with the flattened text and its metadata
+    """
+    try:
+        documents = []
+        for doc in iter_json_records(json_file):
+            text = dict_to_text(doc['content'])
+            documents.append({
+                'text': text,
+                'filename': doc['filename'],
+                'record_id': doc['record_id'],
+                # Keyword tags per section; the text itself is already the document
+                'section_keywords': json.dumps(section_keywords(text), separators=(',', ':'))
+            })
+        return documents
+    except Exception as e:
+        print(f"Error processing {json_file}: {e}")
+        return []
+
+
+def load_documents(data_dir: str) -> List[Dict[str, Any]]:
+    """
+    Load and flatten all JSON files from the data directory.
+    Large corpora are parsed and flattened across worker processes.
+    
+    Returns:
+        List of dictionaries with the flattened text and its metadata
     """
-    documents = []
     data_path = Path(data_dir)
     
     if not data_path.exists():
         print(f"Data directory '{data_dir}' does not exist!")
-        return documents
+        return []
     
-    json_files = list(data_path.glob("*.json"))
+    json_files = sorted(data_path.glob("*.json"))
     
     if not json_files:
         print(f"No JSON files found in '{data_dir}'")
-        return documents
+        return []
     
     print(f"Found {len(json_files)} JSON files to process...")
-    
     for json_file in json_files:
-        try:
-            print(f"Processing: {json_file.name}")
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # Handle both single objects and arrays
-            if isinstance(data, list):
-                for i, record in enumerate(data):
-                    documents.append({
-                        'content': record,
-                        'filename': json_file.name,
-                        'record_id': i
-                    })
-            else:
-                # Single object
-                documents.append({
-                    'content': data,
-                    'filename': json_file.name,
-                    'record_id': 0
-                })
-                
-        except Exception as e:
-            print(f"Error processing {json_file}: {e}")
-    
-    return documents
+        print(f"Processing: {json_file.name}")
+    
+    # Flattening is CPU-bound Python, so processes rather than threads; below
+    # the threshold, worker start-up costs more than it saves
+    if len(json_files) >= PARALLEL_MIN_FILES:
+        workers = min(available_cpus(), len(json_files))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            per_file = list(executor.map(flatten_json_file, json_files, chunksize=4))
+    else:
+        per_file = [flatten_json_file(json_file) for json_file in json_files]
+    
+    return [doc for docs in per_file for doc in docs]
 
 
 def dict_to_text(data: Dict[str, Any]) -> str:
@@ -75,31 +128,97 @@ def dict_to_text(data: Dict[str, Any]) -> str:
     """
     text_parts = []
     
-    def flatten_dict(obj, prefix=""):
+    # Iterative depth-first walk; children are pushed in reverse so leaves
+    # come out in document order without a Python call per node
+    stack = [("", data)]
+    while stack:
+        prefix, obj = stack.pop()
         if isinstance(obj, dict):
-            for key, value in obj.items():
-                new_key = f"{prefix}.{key}" if prefix else key
-                flatten_dict(value, new_key)
+            stack.extend(reversed([
+                (f"{prefix}.{key}" if prefix else key, value)
+                for key, value in obj.items()
+            ]))
         elif isinstance(obj, list):
-            for i, item in enumerate(obj):
-                new_key = f"{prefix}[{i}]" if prefix else f"[{i}]"
-                flatten_dict(item, new_key)
+            stack.extend(reversed([
+                (f"{prefix}[{i}]", item)
+                for i, item in enumerate(obj)
+            ]))
         else:
             # Convert value to string
-            text_parts.append(f"{prefix}: {str(obj)}")
+            text_parts.append(f"{prefix}: {obj}")
     
-    flatten_dict(data)
     return " | ".join(text_parts)
 
 
+def text_hash(text: str) -> str:
+    """Content hash of a document text, used as its embedding cache key"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def load_embedding_cache(cache_path: Path) -> Dict[str, np.ndarray]:
+    """
+    Load previously computed document embeddings.
+    
+    Args:
+        cache_path: .npz file with parallel 'hashes' and 'embeddings' arrays
+        
+    Returns:
+        Dictionary mapping text hash to embedding (empty if no cache exists)
+    """
+    if not cache_path.exists():
+        return {}
+    
+    try:
+        with np.load(cache_path) as data:
+            return dict(zip(data['hashes'].tolist(), data['embeddings']))
+    except Exception as e:
+        print(f"Ignoring unreadable embedding cache '{cache_path}': {e}")
+        return {}
+
+
+def save_embedding_cache(cache_path: Path, cache: Dict[str, np.ndarray]) -> None:
+    """Write the embedding cache back to disk"""
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(cache_path,
+             hashes=np.array(list(cache.keys())),
+             embeddings=np.stack(list(cache.values())).astype(np.float32))
+
+
+def encode_texts(model, texts: List[str]) -> np.ndarray:
+    """
+    Embed texts in one bulk encode call. sentence-transformers already sorts
+    the inputs by length internally, so each mini-batch holds similar-length
+    inputs and little compute is spent on padding.
+    
+    Args:
+        model: Loaded sentence transformer
+        texts: Texts to embed
+        
+    Returns:
+        float32 embeddings in the same order as texts
+    """
+    # The encoder drops everything past max_seq_length tokens anyway, so don't
+    # make the tokenizer walk the whole tail of very long documents
+    char_budget = model.max_seq_length * ENCODE_CHARS_PER_TOKEN
+    texts = [text[:char_budget] for text in texts]
+    
+    with torch.inference_mode():
+        embeddings = model.encode(texts, batch_size=128,
+                                  convert_to_numpy=True, normalize_embeddings=True,
+                                  show_progress_bar=True)
+    return embeddings.astype(np.float32, copy=False)
+
+
 def main():
     """Main indexing function"""
     
     # Configuration
     DATA_DIR = "./content"
     CHROMA_STORE_DIR = "./chroma_store"
+    EMBEDDING_CACHE_DIR = "./embedding_cache"
     COLLECTION_NAME = "company_docs"
     MODEL_NAME = "all-mpnet-base-v2"  # Upgraded from all-MiniLM-L6-v2 for better quality
+    REBUILD = True  # Wipe the store and index from scratch; False upserts into the existing collection
     
     print("=== RAG Indexing Pipeline ===")
     print(f"Data directory: {DATA_DIR}")
@@ -108,80 +227,92 @@ def main():
     print(f"Embedding model: {MODEL_NAME}")
     print()
     
-    # Load sentence transformer model
-    print("Loading sentence transformer model...")
-    model = SentenceTransformer(MODEL_NAME)
-    print("Model loaded successfully!")
-    print()
+    configure_torch_inference()
     
-    # Load JSON documents
+    # Load JSON documents and flatten each record to text
     print("Loading JSON documents...")
-    documents = load_json_files(DATA_DIR)
+    documents = load_documents(DATA_DIR)
     
-    if not documents:
+    texts = [doc['text'] for doc in documents]
+    metadatas = [
+        {
+            'filename': doc['filename'],
+            'record_id': doc['record_id'],
+            'section_keywords': doc['section_keywords']
+        }
+        for doc in documents
+    ]
+    ids = [f"doc_{j}" for j in range(len(documents))]
+    
+    if not texts:
         print("No documents found to index. Exiting.")
         return
     
-    print(f"Loaded {len(documents)} documents total.")
+    print(f"Loaded {len(texts)} documents total.")
     print()
     
     # Initialize ChromaDB
     print("Initializing ChromaDB...")
+    if REBUILD:
+        # Removing the store directory is cheaper than a get + delete round trip
+        # through sqlite, and leaves no stale HNSW segments behind
+        print(f"Rebuilding: removing '{CHROMA_STORE_DIR}'...")
+        shutil.rmtree(CHROMA_STORE_DIR, ignore_errors=True)
     chroma_client = chromadb.PersistentClient(path=CHROMA_STORE_DIR)
     
-    # Get or create collection
-    try:
-        collection = chroma_client.get_collection(COLLECTION_NAME)
-        print(f"Found existing collection '{COLLECTION_NAME}'. Deleting to rebuild...")
-        chroma_client.delete_collection(COLLECTION_NAME)
-    except:
-        pass
-    
-    collection = chroma_client.create_collection(
-        name=COLLECTION_NAME,
-        metadata={"description": "Company documents with embeddings"}
-    )
-    print(f"Created collection '{COLLECTION_NAME}'")
+    # Embeddings are L2-normalized, so inner product equals cosine similarity
+    collection_metadata = {"description": "Company documents with embeddings", "hnsw:space": "ip"}
+    if REBUILD:
+        collection = chroma_client.create_collection(name=COLLECTION_NAME, metadata=collection_metadata)
+        print(f"Created collection '{COLLECTION_NAME}'")
+    else:
+        collection = chroma_client.get_or_create_collection(name=COLLECTION_NAME, metadata=collection_metadata)
+        print(f"Using collection '{COLLECTION_NAME}' ({collection.count()} existing documents)")
     print()
     
-    # Process documents in batches
-    print("Processing documents and generating embeddings...")
-    batch_size = 50
-    total_indexed = 0
+    print("Generating embeddings...")
+    # Reuse embeddings of unchanged texts; only new or edited ones hit the encoder.
+    # One cache file per model and backend/precision, whose vectors differ slightly
+    cache_path = Path(EMBEDDING_CACHE_DIR) / f"{MODEL_NAME.replace('/', '_')}__{encoder_variant()}.npz"
+    embedding_cache = load_embedding_cache(cache_path)
+    hashes = [text_hash(text) for text in texts]
+    misses = [k for k, h in enumerate(hashes) if h not in embedding_cache]
+    print(f"Embedding cache: {len(texts) - len(misses)} hits, {len(misses)} to encode")
     
-    for i in range(0, len(documents), batch_size):
-        batch = documents[i:i + batch_size]
-        
-        # Convert documents to text
-        texts = []
-        metadatas = []
-        ids = []
+    if misses:
+        # Load sentence transformer model (only needed when something must be encoded)
+        print("Loading sentence transformer model...")
+        model = load_sentence_transformer(MODEL_NAME)
+        print(f"Model loaded successfully on {model.device}!")
         
-        for j, doc in enumerate(batch):
-            doc_id = f"doc_{total_indexed + j}"
-            text = dict_to_text(doc['content'])
-            
-            texts.append(text)
-            metadatas.append({
-                'filename': doc['filename'],
-                'record_id': doc['record_id']
-            })
-            ids.append(doc_id)
-        
-        # Generate embeddings
-        embeddings = model.encode(texts, convert_to_tensor=False)
-        embeddings_list = embeddings.tolist()
-        
-        # Add to collection
-        collection.add(
-            embeddings=embeddings_list,
-            documents=texts,
-            metadatas=metadatas,
-            ids=ids
+        new_embeddings = encode_texts(model, [texts[k] for k in misses])
+        for k, embedding in zip(misses, new_embeddings):
+            embedding_cache[hashes[k]] = embedding
+        save_embedding_cache(cache_path, embedding_cache)
+    
+    embeddings = np.stack([embedding_cache[h] for h in hashes])
+    
+    # Add to collection in as few calls as Chroma allows; a corpus below the
+    # client's max batch size (several thousand records) goes in one call
+    # (get_max_batch_size() is new in chromadb 0.5.1; 0.5.0 only has the property)
+    get_max_batch_size = getattr(chroma_client, 'get_max_batch_size', None)
+    batch_size = get_max_batch_size() if get_max_batch_size else chroma_client.max_batch_size
+    total_indexed = 0
+    # Without a rebuild, records with existing ids are overwritten in place
+    write = collection.add if REBUILD else collection.upsert
+    
+    for i in range(0, len(texts), batch_size):
+        # Pass the float32 slice as is. chromadb 0.5.x still converts it with
+        # .tolist() internally; we just avoid building that list ourselves
+        write(
+            embeddings=embeddings[i:i + batch_size],
+            documents=texts[i:i + batch_size],
+            metadatas=metadatas[i:i + batch_size],
+            ids=ids[i:i + batch_size]
         )
         
-        total_indexed += len(batch)
-        print(f"Indexed {total_indexed}/{len(documents)} documents...")
+        total_indexed += len(ids[i:i + batch_size])
+        print(f"Indexed {total_indexed}/{len(texts)} documents...")
     
     print()
     print("=== Indexing Complete ===")
@@ -4,37 +4,70 @@ RAG Querying Script
 Loads the ChromaDB collection and performs similarity search based on user queries.
 """
 
+import hashlib
+import shelve
+import sys
+from functools import lru_cache
+import numpy as np
+import torch
 import chromadb
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict, Any
+from encoder_utils import configure_torch_inference, encoder_variant, load_sentence_transformer, warm_up
+from retrieval_utils import collection_space, distance_to_similarity
+from typing import Callable, List, Dict, Any
 
 
-def format_results(results: Dict[str, Any], query: str) -> None:
+def load_document_cache(collection) -> Dict[str, Dict[str, Any]]:
+    """
+    Read every document's text and display metadata once, so queries only
+    need ids and distances back from Chroma.
+    
+    Args:
+        collection: ChromaDB collection
+        
+    Returns:
+        Mapping of document id to {'text', 'filename', 'record_id'}
+    """
+    records = collection.get(include=['documents', 'metadatas'])
+    return {
+        doc_id: {
+            'text': doc,
+            'filename': metadata.get('filename', 'Unknown'),
+            'record_id': metadata.get('record_id', 'N/A')
+        }
+        for doc_id, doc, metadata in zip(records['ids'], records['documents'], records['metadatas'])
+    }
+
+
+def format_results(results: Dict[str, Any], query: str, documents: Dict[str, Dict[str, Any]],
+                   space: str) -> None:
     """
     Format and display search results in a readable way.
     
     Args:
-        results: Results from ChromaDB query
+        results: Results from ChromaDB query (ids and distances)
         query: Original user query
+        documents: Document cache from load_document_cache
+        space: Distance metric of the collection ('hnsw:space')
     """
     print("\n" + "="*60)
     print(f"QUERY: {query}")
     print("="*60)
     
-    if not results['documents'] or not results['documents'][0]:
+    if not results['ids'] or not results['ids'][0]:
         print("No results found.")
         return
     
-    documents = results['documents'][0]
-    metadatas = results['metadatas'][0]
-    distances = results['distances'][0] if 'distances' in results else [None] * len(documents)
+    ids = results['ids'][0]
+    similarities = distance_to_similarity(np.asarray(results['distances'][0]), space)
     
-    for i, (doc, metadata, distance) in enumerate(zip(documents, metadatas, distances)):
+    for i, (doc_id, similarity) in enumerate(zip(ids, similarities)):
+        record = documents[doc_id]
+        doc = record['text']
         print(f"\n--- RESULT {i+1} ---")
-        print(f"Source File: {metadata.get('filename', 'Unknown')}")
-        print(f"Record ID: {metadata.get('record_id', 'N/A')}")
-        if distance is not None:
-            print(f"Similarity Score: {1 - distance:.4f}")
+        print(f"Source File: {record['filename']}")
+        print(f"Record ID: {record['record_id']}")
+        print(f"Similarity Score: {similarity:.4f}")
         print(f"Content:")
         
         # Truncate very long documents for display
@@ -46,6 +79,64 @@ def format_results(results: Dict[str, Any], query: str) -> None:
         print("-" * 40)
 
 
+def make_query_encoder(model: SentenceTransformer, model_name: str, variant: str,
+                       cache: shelve.Shelf) -> Callable[[str], np.ndarray]:
+    """
+    Build a query encoder backed by an in-memory LRU and a persistent cache.
+    
+    Args:
+        model: Loaded sentence transformer
+        model_name: Model name, part of the cache key so a model change can't
+            return stale embeddings
+        variant: Encoder backend/precision (encoder_variant()), also part of
+            the key since fp16, int8, ONNX and fp32 vectors differ
+        cache: Open shelf mapping sha256 keys to embeddings
+        
+    Returns:
+        Function mapping a query string to its embedding
+    """
+    @lru_cache(maxsize=10000)
+    def encode(query: str) -> np.ndarray:
+        key = hashlib.sha256(f"{model_name}\0{variant}\0{query}".encode('utf-8')).hexdigest()
+        if key in cache:
+            return np.asarray(cache[key], dtype=np.float32)
+        
+        with torch.inference_mode():
+            embedding = model.encode([query], convert_to_numpy=True, normalize_embeddings=True)[0]
+        cache[key] = embedding.tolist()
+        return embedding
+    
+    return encode
+
+
+def run_batch(model: SentenceTransformer, collection, documents: Dict[str, Dict[str, Any]],
+              queries: List[str], top_k: int) -> None:
+    """
+    Encode and search a list of queries in one pass each, then display the results.
+    
+    Args:
+        model: Loaded sentence transformer
+        collection: ChromaDB collection to search
+        documents: Document cache from load_document_cache
+        queries: Query strings, e.g. lines piped on stdin
+        top_k: Number of results per query
+    """
+    with torch.inference_mode():
+        query_embeddings = model.encode(queries, batch_size=64, convert_to_numpy=True,
+                                        normalize_embeddings=True)
+    
+    results = collection.query(
+        query_embeddings=query_embeddings,
+        n_results=top_k,
+        include=['distances']
+    )
+    
+    space = collection_space(collection)
+    for i, query in enumerate(queries):
+        format_results({key: [results[key][i]] for key in ('ids', 'distances')},
+                       query, documents, space)
+
+
 def main():
     """Main querying function"""
     
@@ -54,6 +145,7 @@ def main():
     COLLECTION_NAME = "company_docs"
     MODEL_NAME = "all-mpnet-base-v2"  # Upgraded from all-MiniLM-L6-v2 for better quality
     TOP_K_RESULTS = 3
+    QUERY_CACHE_PATH = "./.query_cache.db"
     
     print("=== RAG Query Interface ===")
     print(f"Chroma store: {CHROMA_STORE_DIR}")
@@ -62,11 +154,15 @@ def main():
     print(f"Returning top {TOP_K_RESULTS} results per query")
     print()
     
+    configure_torch_inference()
+    
     # Load sentence transformer model
     print("Loading sentence transformer model...")
     try:
-        model = SentenceTransformer(MODEL_NAME)
-        print("Model loaded successfully!")
+        model = load_sentence_transformer(MODEL_NAME)
+        print(f"Model loaded successfully on {model.device}!")
+        # Pay graph/kernel initialization now rather than on the first query
+        warm_up(model)
     except Exception as e:
         print(f"Error loading model: {e}")
         return
@@ -85,6 +181,12 @@ def main():
         if doc_count == 0:
             print("The collection is empty. Please run 'rag_index.py' first to index your documents.")
             return
+        
+        # Keep document texts and display metadata in memory so queries only
+        # marshal ids and distances from Chroma
+        documents = load_document_cache(collection)
+        # Distance metric the collection was built with, for similarity scores
+        space = collection_space(collection)
             
     except Exception as e:
         print(f"Error connecting to ChromaDB: {e}")
@@ -92,43 +194,55 @@ def main():
         return
     
     print()
+    
+    # Piped input (e.g. `python rag_query.py < queries.txt`): batch all queries
+    if not sys.stdin.isatty():
+        queries = [line.strip() for line in sys.stdin if line.strip()]
+        print(f"Processing {len(queries)} queries from stdin...")
+        if queries:
+            run_batch(model, collection, documents, queries, TOP_K_RESULTS)
+        return
+    
     print("Ready for queries! (Type 'quit' or 'exit' to stop)")
     print("-" * 50)
     
-    # Query loop
-    while True:
-        try:
-            # Get user input
-            query = input("\nEnter your query: ").strip()
+    # Query loop; embeddings of past queries persist across sessions
+    with shelve.open(QUERY_CACHE_PATH) as cache:
+        encode_query = make_query_encoder(model, MODEL_NAME, encoder_variant(), cache)
+        
+        while True:
+            try:
+                # Get user input
+                query = input("\nEnter your query: ").strip()
             
-            if not query:
-                continue
+                if not query:
+                    continue
                 
-            if query.lower() in ['quit', 'exit', 'q']:
-                print("Goodbye!")
-                break
+                if query.lower() in ['quit', 'exit', 'q']:
+                    print("Goodbye!")
+                    break
             
-            print(f"Searching for: '{query}'...")
+                print(f"Searching for: '{query}'...")
             
-            # Generate query embedding
-            query_embedding = model.encode([query], convert_to_tensor=False)
+                # Generate query embedding (repeat queries come from the cache)
+                query_embedding = encode_query(query)
             
-            # Search the collection
-            results = collection.query(
-                query_embeddings=query_embedding.tolist(),
-                n_results=TOP_K_RESULTS,
-                include=['documents', 'metadatas', 'distances']
-            )
+                # Search the collection
+                results = collection.query(
+                    query_embeddings=query_embedding[np.newaxis, :],
+                    n_results=TOP_K_RESULTS,
+                    include=['distances']
+                )
             
-            # Display results
-            format_results(results, query)
+                # Display results
+                format_results(results, query, documents, space)
             
-        except KeyboardInterrupt:
-            print("\n\nInterrupted by user. Goodbye!")
-            break
-        except Exception as e:
-            print(f"Error processing query: {e}")
-            continue
+            except KeyboardInterrupt:
+                print("\n\nInterrupted by user. Goodbye!")
+                break
+            except Exception as e:
+                print(f"Error processing query: {e}")
+                continue
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Retrieval Utilities
+Helpers shared by the indexer and the query side: section keyword tagging of
+flattened documents and conversion of Chroma distances to similarities.
+"""
+
+import re
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+
+# Keywords that mark a section as carrying key company information
+SECTION_KEYWORDS = ['vision', 'mission', 'services', 'advisory', 'investment',
+                    'global', 'presence', 'founded', 'company']
+_SECTION_KEYWORD_RE = re.compile('|'.join(SECTION_KEYWORDS), re.IGNORECASE)
+
+
+def section_keywords(text: str) -> List[List[str]]:
+    """
+    Find the SECTION_KEYWORDS in each ' | ' separated section of a document.
+    
+    Args:
+        text: Text produced by rag_index.dict_to_text
+        
+    Returns:
+        One sorted list of matched keywords per section
+    """
+    return [
+        sorted({match.lower() for match in _SECTION_KEYWORD_RE.findall(part)})
+        for part in text.split(' | ')
+    ]
+
+
+def split_sections(text: str, keywords: Optional[List[List[str]]] = None) -> List[Dict[str, Any]]:
+    """
+    Split flattened document text into its ' | ' separated sections.
+    
+    Args:
+        text: Text produced by rag_index.dict_to_text
+        keywords: Per-section tags from section_keywords (e.g. stored at index
+            time); recomputed when missing or not matching the text
+        
+    Returns:
+        List of {'kw': [matched SECTION_KEYWORDS], 'text': section} dicts
+    """
+    parts = text.split(' | ')
+    if keywords is None or len(keywords) != len(parts):
+        keywords = section_keywords(text)
+    return [{'kw': kw, 'text': part} for kw, part in zip(keywords, parts)]
+
+
+def distance_to_similarity(distances: np.ndarray, space: str) -> np.ndarray:
+    """Convert Chroma distances between unit-norm vectors to cosine similarity"""
+    if space == 'l2':
+        # Squared L2 between unit vectors is 2 - 2 * cos
+        return 1.0 - distances / 2.0
+    # 'cosine' and 'ip' distances are both 1 - cos for unit vectors
+    return 1.0 - distances
+
+
+def collection_space(collection) -> str:
+    """Distance metric a Chroma collection was built with (Chroma defaults to l2)"""
+    return (collection.metadata or {}).get('hnsw:space', 'l2')
@@ -4,39 +4,31 @@ RAG Test Script
 Demonstrates the RAG pipeline with sample queries.
 """
 
+import numpy as np
 import chromadb
-from sentence_transformers import SentenceTransformer
+from encoder_utils import load_sentence_transformer
+from retrieval_utils import collection_space, distance_to_similarity
 
 
-def test_query(collection, model, query_text):
-    """Test a single query and display results"""
+def display_results(results, query_text, space):
+    """Display the search results of a single query"""
     print(f"\n{'='*60}")
     print(f"QUERY: {query_text}")
     print('='*60)
     
-    # Generate query embedding
-    query_embedding = model.encode([query_text], convert_to_tensor=False)
-    
-    # Search the collection
-    results = collection.query(
-        query_embeddings=query_embedding.tolist(),
-        n_results=3,
-        include=['documents', 'metadatas', 'distances']
-    )
-    
     if not results['documents'] or not results['documents'][0]:
         print("No results found.")
         return
     
     documents = results['documents'][0]
     metadatas = results['metadatas'][0]
-    distances = results['distances'][0]
+    similarities = distance_to_similarity(np.asarray(results['distances'][0]), space)
     
-    for i, (doc, metadata, distance) in enumerate(zip(documents, metadatas, distances)):
+    for i, (doc, metadata, similarity) in enumerate(zip(documents, metadatas, similarities)):
         print(f"\n--- RESULT {i+1} ---")
         print(f"Source File: {metadata.get('filename', 'Unknown')}")
         print(f"Record ID: {metadata.get('record_id', 'N/A')}")
-        print(f"Similarity Score: {1 - distance:.4f}")
+        print(f"Similarity Score: {similarity:.4f}")
         print(f"Content Preview:")
         
         # Show first 300 characters
@@ -59,7 +51,7 @@ def main():
     print(f"Loading model and connecting to database...")
     
     # Load model and connect to ChromaDB
-    model = SentenceTransformer(MODEL_NAME)
+    model = load_sentence_transformer(MODEL_NAME)
     chroma_client = chromadb.PersistentClient(path=CHROMA_STORE_DIR)
     collection = chroma_client.get_collection(COLLECTION_NAME)
     
@@ -74,8 +66,24 @@ def main():
         "successful cases and portfolio"
     ]
     
-    for query in test_queries:
-        test_query(collection, model, query)
+    # Encode all test queries in one batch instead of one forward pass each
+    query_embeddings = model.encode(test_queries, convert_to_numpy=True,
+                                    normalize_embeddings=True)
+    
+    # Search all of them in a single collection.query call
+    results = collection.query(
+        query_embeddings=query_embeddings,
+        n_results=3,
+        include=['documents', 'metadatas', 'distances']
+    )
+    
+    space = collection_space(collection)
+    for i, query in enumerate(test_queries):
+        display_results({
+            'documents': [results['documents'][i]],
+            'metadatas': [results['metadatas'][i]],
+            'distances': [results['distances'][i]]
+        }, query, space)
     
     print(f"\n{'='*60}")
     print("Test completed! You can now use rag_query.py for interactive queries.")
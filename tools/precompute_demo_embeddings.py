@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Precompute Demo Query Embeddings
+Encodes the hard-coded demo/sample questions once and stores them in
+demo_queries.npz so RAGWithGemini can skip the encoder for them.
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# Allow running as `python tools/precompute_demo_embeddings.py` from the repo root
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from app import SAMPLE_QUESTIONS
+from demo_gemini import DEMO_QUESTIONS
+from encoder_utils import encoder_variant, load_sentence_transformer
+from quick_test import TEST_QUESTION
+from rag_gemini import (DEFAULT_MODEL_NAME, DEMO_QUERIES_PATH, ENCODE_KWARGS,
+                        normalize_query, query_key)
+
+
+def main():
+    """Encode every canonical question and write them to the .npz store"""
+    
+    questions = sorted({
+        normalize_query(q)
+        for q in [*SAMPLE_QUESTIONS, *DEMO_QUESTIONS, TEST_QUESTION]
+    })
+    output_path = ROOT_DIR / DEMO_QUERIES_PATH
+    
+    # Same loader (and ENCODER_BACKEND/ENCODER_QUANTIZE settings) as RAGWithGemini,
+    # so the stored vectors match what the runtime encoder would produce
+    print(f"Loading sentence transformer: {DEFAULT_MODEL_NAME}...")
+    model = load_sentence_transformer(DEFAULT_MODEL_NAME)
+    
+    print(f"Encoding {len(questions)} demo questions...")
+    embeddings = model.encode(questions, **ENCODE_KWARGS).astype(np.float32)
+    
+    np.savez(
+        output_path,
+        model_name=np.array(DEFAULT_MODEL_NAME),
+        encoder_variant=np.array(encoder_variant()),
+        **{query_key(q).hex(): emb for q, emb in zip(questions, embeddings)}
+    )
+    print(f"Saved {len(questions)} embeddings to '{output_path}'")
+
+
+if __name__ == "__main__":
+    main()
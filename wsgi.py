@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+WSGI entry point for production deployments.
+Initializes the RAG system once in the gunicorn master (see gunicorn.conf.py)
+so forked workers share the loaded model pages copy-on-write.
+"""
+
+import os
+
+# Probe for a GPU through NVML so the check itself doesn't initialize CUDA
+# in the master (a forked child cannot use a CUDA context from its parent)
+os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+
+import torch
+
+import app as chatbot
+from app import app
+
+success, msg = chatbot.initialize_rag()
+if success:
+    if torch.cuda.is_available():
+        # The encoder would be moved to the GPU here, before the fork; each
+        # worker loads its own copy on first use instead
+        print("💤 CUDA available - workers load the encoder on first use")
+    else:
+        # Load the encoder weights before forking rather than lazily in every worker
+        chatbot.rag_system.load_encoder()
+    print(f"✅ {msg}")
+else:
+    print(f"❌ {msg}")
+    print("⚠️  Workers will initialize the system on first request")